@@ -2,32 +2,60 @@
 
 require 'lumberg'
 require 'net/http'
+require 'openssl'
+require 'resolv'
 require 'uri'
 require "webdrivers"
 require "selenium-webdriver"
 require 'yaml'
 require 'fileutils'
+require 'set'
 
 
 class WhmChecker
 
+  # Trackers that never affect how a page looks but can hold up its load
+  BLOCKED_URLS = %w[
+    *google-analytics.com*
+    *googletagmanager.com*
+    *doubleclick.net*
+  ]
+
+  LOG_FORMAT = proc {|severity, datetime, progname, msg|
+    "#{datetime} #{msg}\n"
+  }
+
+  # Logger syncs files it opens itself, so open the log here to keep it
+  # buffered. Checkers logging to the same place share one IO.
+  def self.log_io(logfile)
+    @log_ios ||= {}
+    @log_ios[logfile] ||= logfile ? File.open(logfile, 'a') : STDOUT
+  end
+
   def initialize(config = {})
     config[:output_dir] ||= '.'
     @outputdir = config[:output_dir]
-    @log = Logger.new(config[:logfile] || STDOUT, formatter: proc {|severity, datetime, progname, msg|
-      "#{datetime} #{msg}\n"
-    })
+    @logdev = self.class.log_io(config[:logfile])
+    @log = Logger.new(@logdev, formatter: LOG_FORMAT)
     @dns = Resolv::DNS.new
     @directory_format = config[:directory_format] || "%Y%m%d"
-    @ip_whitelist = []
+    @ip_whitelist = Set.new
+    @dns_cache = {}
+    @dns_threads = config[:dns_threads] || 16
+    @api_threads = config[:api_threads] || 8
     @lastrun_file = config[:lastrun_file] || "lastrun.txt"
 
-    selenium_options = Selenium::WebDriver::Chrome::Options.new
-    selenium_options.add_argument('--headless')
-    @driver = Selenium::WebDriver.for :chrome, options: selenium_options
-
     @read_timeout = 30
     @open_timeout = 30
+    @load_wait = config[:load_wait] || 5
+
+    # Pool of headless browsers shared by the fetch threads
+    @workers = config[:workers] || 4
+    @drivers = Queue.new
+    @driver_uses = Hash.new(0)
+    @driver_max_uses = config[:driver_max_uses] || 200
+    at_exit { close }
+    @workers.times { @drivers << new_driver }
   end
 
   def check_accounts(host, hash, date = Time.now.strftime(@directory_format))
@@ -46,134 +74,299 @@ class WhmChecker
     ip_addr = server.list_ips
 
     unless ip_addr[:message].nil?
-        @log.error "server.list_ips: #{ip_addr[:message]}"
+        @log.error { "server.list_ips: #{ip_addr[:message]}" }
         exit
     end
 
     if ip_addr[:params].is_a? Array
-      @ip_whitelist = ip_addr[:params].collect {|a| a[:ip]}
+      @ip_whitelist = Set.new(ip_addr[:params].collect {|a| a[:ip]})
     else
-      @ip_whitelist = [ip_addr[:params][:ip]]
+      @ip_whitelist = Set[ip_addr[:params][:ip]]
     end      
 
-    result[:params][:acct].each do |acct|
-      next if acct[:suspended]
+    accounts = result[:params][:acct].reject {|acct| acct[:suspended] }
+    addons = {}
 
+    each_in_parallel(accounts, @api_threads) do |acct|
+      # Lumberg servers keep state between requests, so each concurrent
+      # lookup needs its own
       addon = Lumberg::Cpanel::AddonDomain.new(
-        server:       server,  # An instance of Lumberg::Server
+        server:       Lumberg::Whm::Server.new(host: host, hash: hash),
         api_username: acct[:user]  # User whose cPanel we'll be interacting with
       )
 
-      domlist = []
-      domains = []
-
       begin
-        domlist = addon.list[:params][:data]
+        addons[acct[:user]] = addon.list[:params][:data]
       rescue StandardError => ex
-        @log.warn "host=#{host} user=#{acct[:user]} error=could_not_fetch_addons"
+        @log.warn { "host=#{host} user=#{acct[:user]} error=could_not_fetch_addons" }
       end
+    end
 
-      domlist.unshift(acct).each do |account_domain|
-        result, message = check_in_whitelist(account_domain[:domain])
-        if result
-          domains << account_domain[:domain]
-        else
-          @log.warn "host=#{host} user=#{acct[:user]} domain=#{account_domain[:domain]} code=#{message}"
-        end
+    candidates = []
 
-      end
+    accounts.each do |acct|
+      domlist = addons[acct[:user]] || []
+      domains = [acct[:domain]] + domlist.collect {|d| d[:domain] }
+      domains.compact.each {|dom| candidates << [acct[:user], dom] }
+    end
+
+    # A domain listed twice for an account would otherwise be fetched by
+    # two workers writing the same files
+    candidates.uniq!
+
+    # Resolve every domain on the server up front so the whitelist checks
+    # below are cache lookups
+    resolve_all(candidates.collect {|user, dom| dom })
+
+    jobs = candidates.select do |user, dom|
+      whitelisted, message = check_in_whitelist(dom)
+      @log.warn { "host=#{host} user=#{user} domain=#{dom} code=#{message}" } unless whitelisted
+      whitelisted
+    end
+
+    # Pages that already have both files in this directory were fetched by
+    # an earlier invocation for the same date
+    existing = Set.new(Dir.children(directory))
+    skipped, jobs = jobs.partition do |user, dom|
+      existing.include?("#{user}-#{dom}.html") && existing.include?("#{user}-#{dom}.png")
+    end
+
+    skipped.each do |user, dom|
+      @log.info { "host=#{host} user=#{user} domain=#{dom} code=skipped" }
+    end
+
+    each_in_parallel(jobs, @workers) do |user, dom|
+      # A name of its own, so it stays local to each worker's block
+      page = with_driver {|driver| fetch_page(user, dom, directory, driver) }
 
-      domains.each do |dom|
-        result = fetch_page(acct[:user], dom, directory)
-        log = "host=#{host} user=#{acct[:user]} domain=#{dom}"
-        log = log + " code=#{result[:code]}" if result.has_key? :code
-        log = log + " location=#{result[:location]}" if result.has_key? :location
-        log = log + " digest=#{result[:digest]}" if result.has_key? :digest
-        @log.info(log)
+      @log.info do
+        fields = ["host=#{host}", "user=#{user}", "domain=#{dom}"]
+        [:code, :location, :digest].each do |key|
+          fields << "#{key}=#{page[key]}" if page.has_key? key
+        end
+        fields.join(' ')
       end
     end
+    @logdev.flush
+
+    # One fsync for the directory rather than one per file written above
+    File.open(directory) {|d| d.fsync }
 
     f = File.open(@lastrun_file, 'a')
     f.puts directory
     f.close
   end
 
-  def check_in_whitelist(dom)
-    begin
-      ip = @dns.getaddress(dom)
-    rescue Resolv::ResolvError
-      return false, "unresolvable"
+  # Quit every browser in the pool; safe to call more than once
+  def close
+    until @drivers.empty?
+      driver = @drivers.pop
+      begin
+        driver.quit
+      rescue StandardError
+        nil
+      end
     end
+    @logdev.flush
+  end
+
+  def check_in_whitelist(dom)
+    ip = resolve(dom)
+    return false, "unresolvable" if ip.nil?
 
-    if @ip_whitelist.include? ip.to_s
+    if @ip_whitelist.include? ip
       return true, nil
     else
       return false, "not_whitelisted"
     end
   end
 
-  def fetch_page(user, dom, directory)
-    uri = URI.parse("http://#{dom}")
+  # Resolve a domain once per run; unresolvable domains are cached as nil
+  def resolve(dom)
+    return dom if dom =~ Resolv::IPv4::Regex || dom =~ Resolv::IPv6::Regex
+    return @dns_cache[dom] if @dns_cache.has_key? dom
+
+    @dns_cache[dom] = begin
+      @dns.getaddress(dom).to_s
+    rescue Resolv::ResolvError
+      nil
+    end
+  end
+
+  # Warm the DNS cache for a batch of domains using a pool of threads
+  def resolve_all(domains)
+    pending = domains.uniq.reject {|dom| @dns_cache.has_key? dom }
+    each_in_parallel(pending, @dns_threads) {|dom| resolve(dom) }
+  end
+
+  # Call the block for each item, spread across up to `threads` threads
+  def each_in_parallel(items, threads)
+    queue = Queue.new
+    items.each {|item| queue << item }
+    queue.close
+
+    Array.new([threads, queue.size].min) do
+      Thread.new do
+        while (item = queue.pop)
+          yield item
+        end
+      end
+    end.each(&:join)
+  end
+
+  def new_driver
+    selenium_options = Selenium::WebDriver::Chrome::Options.new
+    selenium_options.add_argument('--headless')
+    selenium_options.add_argument('--disable-gpu')
+    selenium_options.add_argument('--disable-extensions')
+    selenium_options.add_argument('--disable-background-networking')
+    capabilities = Selenium::WebDriver::Remote::Capabilities.chrome(page_load_strategy: 'eager')
+    driver = Selenium::WebDriver.for :chrome, options: selenium_options, desired_capabilities: capabilities,
+                                              driver_opts: {silent: true}
+    driver.manage.timeouts.page_load = @read_timeout
+    driver.execute_cdp('Network.enable')
+    driver.execute_cdp('Network.setBlockedURLs', urls: BLOCKED_URLS)
+    driver
+  end
 
-    if File.exist?("#{directory}/#{user}-#{dom}.html") && File.exist?("#{directory}/#{user}-#{dom}.png")
-      return {code: "skipped"}
+  # Borrow a browser from the pool for the duration of the block
+  def with_driver
+    driver = @drivers.pop
+    begin
+      yield driver
+    ensure
+      @drivers << recycle(driver)
     end
+  end
+
+  # Chrome's memory use grows over many page loads, so replace a driver
+  # once it has served :driver_max_uses pages. If a new browser can't be
+  # started the old one stays in the pool and is retried after its next use.
+  def recycle(driver)
+    @driver_uses[driver] += 1
+    return driver if @driver_uses[driver] < @driver_max_uses
 
     begin
-      location, response = fetch_url uri
+      replacement = new_driver
+    rescue StandardError => ex
+      @log.warn { "error=could_not_recycle_driver message=#{ex}" }
+      return driver
+    end
 
-      if response == 0
-        return {location: location, code: "too_many_redirects"}
+    @driver_uses.delete(driver)
+    begin
+      driver.quit
+    rescue StandardError
+      nil
+    end
+    replacement
+  end
+
+  # With the eager strategy navigation returns at DOMContentLoaded; give
+  # images and styles up to :load_wait seconds to finish before the
+  # screenshot
+  def wait_for_load(driver)
+    Selenium::WebDriver::Wait.new(timeout: @load_wait).until do
+      driver.execute_script('return document.readyState') == 'complete'
+    end
+  rescue Selenium::WebDriver::Error::TimeoutError
+    nil
+  end
+
+  # Write through a temporary file so an interrupted run never leaves a
+  # truncated file behind for the skip check to treat as complete. The
+  # file is only moved into place if the block returns a true value.
+  def atomic_write(path)
+    tmp = "#{path}.tmp"
+    renamed = false
+    begin
+      result = File.open(tmp, 'wb') {|f| yield f }
+      if result
+        File.rename(tmp, path)
+        renamed = true
       end
+      result
+    ensure
+      # Also covers the block raising part way through
+      File.delete(tmp) if !renamed && File.exist?(tmp)
+    end
+  end
 
-      # Dump status and body
-      f = File.new("#{directory}/#{user}-#{dom}.html", "w")
-      f.puts location
-      unless response.nil?
-        f.puts response.code
-        f.puts response.body
+  def fetch_page(user, dom, directory, driver)
+    uri = URI.parse("http://#{dom}")
+
+    begin
+      location = response = nil
+      digest = OpenSSL::Digest::SHA256.new
+
+      # Dump status and body, streaming the body into the digest as well
+      atomic_write("#{directory}/#{user}-#{dom}.html") do |f|
+        location, response = fetch_url(uri) do |final_uri, final_response|
+          f.write "#{final_uri}\n#{final_response.code}\n"
+          last = ""
+          final_response.read_body do |chunk|
+            f.write chunk
+            digest << chunk
+            last = chunk unless chunk.empty?
+          end
+          # Match IO#puts, which only adds a newline when one is missing
+          f.write "\n" unless last.end_with?("\n")
+        end
+        response.is_a? Net::HTTPResponse
+      end
+
+      if response == 0
+        return {location: location, code: "too_many_redirects"}
       end
-      f.close
 
       return if response.code == 521
 
       # Dump image
-      @driver.navigate.to location
-      @driver.manage.window.resize_to(1440, 2000)
-      @driver.save_screenshot "#{directory}/#{user}-#{dom}.png"
-      return { location: location, code: response.code, digest: Digest::SHA2.hexdigest(response.body)  }
+      driver.navigate.to location
+      wait_for_load(driver)
+      driver.manage.window.resize_to(1440, 2000)
+      png = driver.screenshot_as(:png)
+      atomic_write("#{directory}/#{user}-#{dom}.png") {|f| f.write png }
+      return { location: location, code: response.code, digest: digest.hexdigest }
     rescue StandardError => ex
       return { code: ex.to_s }
     end
   end
 
+  # Follow redirects from uri and return the final URI and response. When
+  # a block is given it is called with both before the final body is read,
+  # so the caller can stream it.
   def fetch_url(uri, limit = 5)
-    if limit == 0
-      return 0, uri
-    end
+    http = nil
+
+    limit.times do
+      uri.path = "/" if uri.path.empty?
+
+      # Keep the connection open while redirects stay on the same server
+      unless http && http.address == uri.host && http.port == uri.port && http.use_ssl? == uri.instance_of?(URI::HTTPS)
+        http.finish if http && http.started?
+        http = Net::HTTP.new(uri.host, uri.port)
+        http.use_ssl = uri.instance_of?(URI::HTTPS)
+        http.read_timeout = @read_timeout
+        http.open_timeout = @open_timeout
+        http.start
+      end
 
-    uri.path = "/" if uri.path.empty?
-    response = nil
+      response = nil
+      http.request_get(uri.request_uri) do |res|
+        response = res
+        yield uri, res if block_given? && !res.is_a?(Net::HTTPRedirection)
+      end
+      return uri, response unless response.is_a? Net::HTTPRedirection
 
-    begin
-      http = Net::HTTP.new(uri.host, uri.port)
-      http.use_ssl = uri.instance_of?(URI::HTTPS)
-      http.read_timeout = @read_timeout
-      http.open_timeout = @open_timeout
-      response = http.start { |http| http.get(uri.path) }
-    rescue SocketError
-      return 521, nil  # Server down
-    end
-
-    case response
-    when Net::HTTPRedirection then
-      location = response['location']
-      l, r = fetch_url(URI(location), limit - 1)
-      return l, r
-    else
-      return uri, response
+      uri = uri + response['location']
     end
 
+    return uri, 0
+  rescue SocketError
+    return 521, nil  # Server down
+  ensure
+    http.finish if http && http.started?
   end
 
 end
@@ -185,6 +378,10 @@ config = YAML::load(File.open(configfile))
 
 whm = WhmChecker.new(config[:config])
 
-config[:servers].each do |server|
-  whm.check_accounts(server[:host], server[:hash])
+begin
+  config[:servers].each do |server|
+    whm.check_accounts(server[:host], server[:hash])
+  end
+ensure
+  whm.close
 end